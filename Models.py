@@ -1,12 +1,14 @@
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, HasMany, BelongsTo
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000),uuid.uuid4().hex)
 
 class User(Model):                                                       #user表的类
-    __table__ = "Users"
+    __table__ = 'users'
+    __unique__ = ('email',)
+    __indexes__ = ('created_at',)
 
     id = StringField(primary_key=True,default=next_id(),ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -18,6 +20,7 @@ class User(Model):                                                       #user
 
 class Blog(Model):                                                      #博客表的类
     __table__ = 'blogs'
+    __indexes__ = ('created_at', 'user_id')
 
     id = StringField(primary_key=True,default=next_id(),ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -25,20 +28,26 @@ class Blog(Model):                                                      #博客
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(deferred=True, ddl='mediumtext')                #正文较大,列表页不查询,需要时用load()加载
     created_at = FloatField(default=time.time)
 
+    comments = HasMany('Comment', 'blog_id')                            #该博客的评论
+
 class Comment(Model):                                                   #评论表的类
     __table__ = 'comments'
+    __counters__ = ('blog_id',)                                         #维护评论总数和每篇博客的评论数
+    __indexes__ = ('created_at', 'blog_id')
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
     created_at = FloatField(default=time.time)
 
+    user = BelongsTo('User', 'user_id')                                 #评论的作者
+
 
 
 
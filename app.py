@@ -4,18 +4,20 @@ import asyncio, os, json, time,hashlib
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
-import orm
+import orm, serializer
 from coroweb import add_routes, add_static
 
 from handlers import cookie2user
+from config import configs
 # 1、对Environment类的参数options进行配置。
 # 2、使用jinja提供的模板加载器加载模板文件，程序中选用FileSystemLoader加载器直接从模板文件夹加载模板。
 # 3、有了加载器和options参数，传递给Environment类，添加过滤器，完成初始化
 
 def init_jinja2(app,**kw):
     logging.info('init jinja2...')
+    production = kw.get('production', False)         # 生产模式：启动时预编译全部模板，使用字节码缓存，关闭自动重载
     # 配置options参数
     options = dict(
         # 自动转义xml/html的特殊字符
@@ -26,10 +28,13 @@ def init_jinja2(app,**kw):
         # 变量的开始、结束标志
         variable_start_string=kw.get('variable_start_string', '{{'),
         variable_end_string=kw.get('variable_end_string', '}}'),
-        # 自动加载修改后的模板文件
-        auto_reload=kw.get('auto_reload', True)
+        # 自动加载修改后的模板文件，生产模式下不再每次get_template都检查文件修改时间
+        auto_reload=kw.get('auto_reload', not production)
 
          )
+    if production:
+        # 编译结果写入文件系统字节码缓存，同一目录被多个worker进程共享，只有第一个进程需要编译
+        options['bytecode_cache'] = FileSystemBytecodeCache(kw['bytecode_cache_dir']) if kw.get('bytecode_cache_dir') else FileSystemBytecodeCache()
     # 获取模板文件夹路径
     path = kw.get('path',None)
     if not path:
@@ -44,6 +49,13 @@ def init_jinja2(app,**kw):
         for name, f in filters.items():
             # filters是Environment类的属性：过滤器字典
             env.filters[name] = f
+    if production:
+        # 过滤器在编译时检查，需在添加过滤器之后预编译
+        start = time.time()
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        logging.info('precompiled %s templates in %.1f ms' % (len(names), (time.time() - start) * 1000))
             # 所有的一切是为了给app添加__templating__字段
             # 前面将jinja2的环境配置都赋值给env了，这里再把env存入app的dict中，这样app就知道要到哪儿去找模板，怎么解析模板。
     app['__template__'] = env
@@ -87,7 +99,7 @@ async def response_factory(app,handler):
 
         r = await handler(request)
 
-        logging.info('response result = %s' % str(r))
+        logging.debug('response result type = %s', type(r).__name__)     # 不再格式化整个返回值
 
         if isinstance(r,web.StreamResponse):        # StreamResponse是所有Response对象的父类
             return r            # 无需构造，直接返回
@@ -110,11 +122,10 @@ async def response_factory(app,handler):
                 # 在后续构造视图函数返回值时，会加入__template__值，用以选择渲染的模板
             template = r.get('__template__',None)
             if template is None:        # 不带模板信息，返回json对象
-                resp = web.Response(body=json.dumps(r,ensure_ascii=False,default=lambda obj: obj.__dict__).encode('utf-8'))
+                resp = web.Response(body=serializer.dumps(r))
 
-                # ensure_ascii：默认True，仅能输出ascii格式数据。故设置为False。
-                # default：r对象会先被传入default中的函数进行处理，然后才被序列化为json对象
-                # __dict__：以dict形式返回对象属性和值的映射
+                # serializer优先使用orjson/ujson，直接得到utf-8编码的bytes
+                # Model是dict子类可原生序列化，Row及其他对象先经serializer.default转为dict
 
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
@@ -145,6 +156,12 @@ async def response_factory(app,handler):
         return resp
     return response
 
+async def identity_map_factory(app,handler):        #每个请求使用独立的主键缓存,同一请求内重复的Model.find只查询一次
+    async def identity_map(request):
+        with orm.identity_map():
+            return await handler(request)
+    return identity_map
+
 async def auth_factory(app,handler):                #解析cookie的工厂函数
     async def auth(request):
         logging.info('check user: %s %s ' % (request.method,request.path))
@@ -166,9 +183,9 @@ async def auth_factory(app,handler):                #解析cookie的工厂函数
 if __name__ == '__main__':
 
     async def init(loop):
-        await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='www-data', password='www-data', db='awesome')
-        app = web.Application(loop=loop, middlewares=[logger_factory,auth_factory,response_factory])               #创建web服务器实例app，处理URL、HTTP协议
-        init_jinja2(app, filters=dict(datetime=datetime_filter),path=r'D:\python程序\awesome-python3-webapp\www\templates')
+        await orm.create_pool(loop=loop, **configs.db)          #数据库、连接池、副本等配置都来自config_default/config_override
+        app = web.Application(loop=loop, middlewares=[logger_factory,identity_map_factory,auth_factory,response_factory])               #创建web服务器实例app，处理URL、HTTP协议
+        init_jinja2(app, filters=dict(datetime=datetime_filter),path=r'D:\python程序\awesome-python3-webapp\www\templates',production=not configs.debug)
         add_routes(app, 'handlers')
         add_static(app)
         srv = await loop.create_server(app.make_handler(),'127.0.0.1',9000)        #创建监听服务   make_handle()为创建HTTP协议簇，
@@ -0,0 +1,185 @@
+'''
+orm和web层的基准测试,使用SQLite后端,不需要MySQL
+
+用法:
+    python bench.py statements [n]          比较固定语句与每次拼接、替换占位符的语句,以及Blog.find的耗时
+    python bench.py handler [n]             通过aiohttp的测试客户端请求视图函数,以及直接调用RequestHandler的耗时
+    python bench.py rows [n]                比较n个Model与Row对象占用的内存和属性访问的耗时
+    python bench.py findall [n]             n行(默认50000)的Blog.findAll每秒构造的记录数,以及只构造对象的速度
+    python bench.py savemany [n]            插入n条(默认100000)Comment,比较逐条save()与save_many的每秒行数
+    python bench.py pages [page] [size]     比较find_page与findAll(limit=(offset, size))取第1页和第page页(默认10000)的耗时
+    python bench.py serialize [n]           序列化n个(默认1000)Blog对象和Row,比较已安装的各json实现的耗时
+'''
+
+import asyncio, logging, os, sys, tempfile, time, tracemalloc
+
+logging.disable(logging.INFO)                   #不输出定义模型时的日志
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+import orm
+import schema
+import Models
+import coroweb
+import serializer
+from coroweb import get, post
+
+
+def timeit(fn, n):                              #执行n次,返回每次的平均耗时(微秒)
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+async def atimeit(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        await fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+async def create_database():                    #在临时文件中建立SQLite数据库和全部表
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    await orm.create_pool(None, backend='sqlite', db=path)
+    for sql in schema.create_schema(dialect='sqlite'):
+        await orm.execute(sql, [])
+    return path
+
+
+def bench_statements(n=500000):
+    model = Models.Blog
+    orm._set_backend('mysql')                   #mysql的占位符需要替换,才能体现差别
+    built = lambda: orm.prepare('{} where `{}`=?'.format(model.__select__, model.__primary_key__))
+    fixed = lambda: orm.prepare(model.__find__)
+    print('build + replace per call   {:8.3f} us'.format(timeit(built, n)))
+    print('precomputed statement      {:8.3f} us'.format(timeit(fixed, n)))
+
+    async def find():
+        await create_database()
+        await model(id='b1', user_id='u', user_name='n', user_image='i', name='t', summary='s', content='c', created_at=time.time()).save()
+        print('Blog.find on sqlite        {:8.3f} us'.format(await atimeit(lambda: model.find('b1'), n // 100)))
+    asyncio.run(find())
+
+
+def bench_rows(n=100000):
+    model = Models.Blog
+    values = dict(id='b1', user_id='u1', user_name='n', user_image='i', name='t', summary='s', created_at=1.0)
+    for label, make in (('Model', lambda: model(**values)), ('Row', lambda: model.__row__(**values))):
+        tracemalloc.start()
+        objs = [make() for _ in range(n)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        obj = objs[0]
+        print('{:6} {:8.1f} bytes/object  attribute access {:8.3f} us'.format(label, size / n, timeit(lambda: obj.name, n * 10)))
+
+
+def bench_findall(n=50000):
+    model = Models.Blog
+
+    async def run():
+        await create_database()
+        await model.save_many([model(id='%012d' % i, user_id='u%d' % (i % 100), user_name='n', user_image='i', name='t %d' % i,
+                                     summary='s' * 100, content='c' * 1000, created_at=float(i)) for i in range(n)])
+        for label, kw in (('findAll', {}), ('findAll compact', dict(compact=True))):
+            best = None
+            for _ in range(3):                  #取三次中最快的一次
+                start = time.perf_counter()
+                await model.findAll(**kw)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print('{:24} {:10.0f} rows/s'.format(label, n / best))
+        rs = await orm.select(model.__select__, [], tuples=True)
+        dicts = [dict(zip(model.__columns__, r)) for r in rs]
+        compact = model._factory(tuple(model.__columns__), True)
+        for label, build in (('cls(**dict row)', lambda: [model(**r) for r in dicts]),
+                             ('__from_row__', lambda: [model.__from_row__(r) for r in rs]),
+                             ('compact from_row', lambda: [compact(r) for r in rs])):
+            best = min(timeit(build, 1) for _ in range(3))
+            print('{:24} {:10.0f} rows/s'.format(label, len(rs) / best * 1e6))
+    asyncio.run(run())
+
+
+def bench_savemany(n=100000, loop_rows=10000):
+    model = Models.Comment
+    comments = [model(id='%012d' % i, blog_id='b%d' % (i % 1000), user_id='u', user_name='n', user_image='i',
+                      content='c' * 200, created_at=float(i)) for i in range(n)]
+
+    async def run():
+        await create_database()
+        rows = comments[:min(n, loop_rows)]     #逐条save()太慢,只插入前loop_rows条
+        start = time.perf_counter()
+        for c in rows:
+            await c.save()
+        print('save() x {:<8}          {:10.0f} rows/s'.format(len(rows), len(rows) / (time.perf_counter() - start)))
+        await orm.execute('delete from `{}`'.format(model.__table__), [])
+        await orm.execute('delete from `counters`', [])
+        start = time.perf_counter()
+        await model.save_many(comments)
+        print('save_many x {:<8}       {:10.0f} rows/s'.format(n, n / (time.perf_counter() - start)))
+        print('cached count {}'.format(await model.findNumber('*', mode='cached')))
+    asyncio.run(run())
+
+
+def bench_pages(page=10000, size=20, rounds=20):
+    model = Models.Blog
+    n = page * size
+
+    async def run():
+        await create_database()
+        await model.save_many([model(id='%012d' % i, user_id='u', user_name='n', user_image='i', name='t', summary='s',
+                                     content='c', created_at=float(i)) for i in range(n)])
+        for p in (1, page):
+            offset = (p - 1) * size
+            after = (await model.find_page(size=offset))[1] if offset else None     #准备游标,不计时
+            keyset = await atimeit(lambda: model.find_page(after=after, size=size), rounds)
+            limit = await atimeit(lambda: model.findAll(orderBy='created_at desc, id desc', limit=(offset, size)), rounds)
+            print('page {:<6} find_page {:10.1f} us   findAll offset {:10.1f} us'.format(p, keyset, limit))
+    asyncio.run(run())
+
+
+def bench_serialize(n=1000, rounds=20):
+    blogs = [Models.Blog(id='%050d' % i, user_id='%050d' % (i % 50), user_name='用户%d' % i, user_image='http://www.gravatar.com/avatar/%d' % i,
+                         name='博客标题 %d' % i, summary='摘要' * 20, content='正文内容 ' * 200, created_at=time.time()) for i in range(n)]
+    rows = [Models.Blog.__row__(**blog) for blog in blogs]
+    for name, fn in serializer._encoders.items():
+        for label, items in (('Model', blogs), ('Row', rows)):
+            payload = dict(blogs=items)
+            fn(payload)
+            print('{:8} {:6} {:8.2f} ms/response  {} bytes'.format(name, label, timeit(lambda: fn(payload), rounds) / 1000, len(fn(payload))))
+
+
+def bench_handler(n=2000):
+    @get('/blog/{id}')
+    async def show(request, *, id, page: int = 1, tag: list[str] = None):
+        return web.Response(text=id)
+
+    @post('/api/blogs')
+    async def create(*, name, summary, content, **kw):
+        return web.Response(text=name)
+
+    async def run():
+        app = web.Application()
+        coroweb.add_route(app, show)
+        coroweb.add_route(app, create)
+        body = dict(name='t', summary='s', content='c' * 1000)
+        async with TestClient(TestServer(app)) as client:
+            async def request_get():
+                async with client.get('/blog/b1?page=2&tag=a&tag=b') as r:
+                    await r.read()
+            async def request_post():
+                async with client.post('/api/blogs', json=body) as r:
+                    await r.read()
+            print('GET  via test client       {:8.3f} us'.format(await atimeit(request_get, n)))
+            print('POST via test client       {:8.3f} us'.format(await atimeit(request_post, n)))
+        handler = coroweb.RequestHandler(app, show)
+        request = make_mocked_request('GET', '/blog/b1?page=2&tag=a&tag=b', match_info={'id': 'b1'})
+        print('RequestHandler only        {:8.3f} us'.format(await atimeit(lambda: handler(request), n * 10)))
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'statements'
+    args = [int(a) for a in sys.argv[2:]]
+    globals()['bench_' + name](*args)
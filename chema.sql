@@ -11,13 +11,13 @@ grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' iden
 create table users (
     `id` varchar(50) not null,
     `email` varchar(50) not null,
-    `passwd` varchar(50) not null,
-    `admin` bool not null,
+    `password` varchar(50) not null,
+    `admin` boolean not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
-    unique key `idx_email` (`email`),
     key `idx_created_at` (`created_at`),
+    unique key `idx_email` (`email`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
@@ -31,6 +31,7 @@ create table blogs (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_user_id` (`user_id`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
@@ -43,5 +44,12 @@ create table comments (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id` (`blog_id`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
+
+create table counters (
+    `name` varchar(200) not null,
+    `value` bigint not null,
+    primary key (`name`)
+) engine=innodb default charset=utf8;
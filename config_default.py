@@ -3,11 +3,17 @@
 configs = {
     'debug': True,
     'db': {
+        'backend': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
-        'user': 'www',
-        'password': 'www',
-        'db': 'awesome'
+        'user': 'www-data',
+        'password': 'www-data',
+        'db': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        'pool_recycle': 3600,
+        'replicas': [],
+        'read_your_writes': 1
     },
     'session': {
         'secret': 'Awesome'
@@ -1,30 +1,37 @@
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, enum, types, typing, json, tempfile
 
 from urllib import parse
 
-from aiohttp import web
+from aiohttp import web, hdrs, BodyPartReader
+from multidict import MultiDict
 
-#from apis import APIError
+from apis import APIError, APIValueError
 
 
-def get(path):                                  #视图函数的装饰器，传递储存URL信息(path,method)
+MAX_BODY_SIZE = 1024 * 1024                     # 请求体的默认大小上限，可在@get/@post中用max_body为单个路由指定
+CHUNK_SIZE = 64 * 1024                          # 读取请求体的块大小
+
+
+def get(path, max_body=None):                   #视图函数的装饰器，传递储存URL信息(path,method)
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args,**kw):
             return func(*args,**kw)
         wrapper.__method__ = 'GET'
         wrapper.__path__ = path
+        wrapper.__max_body__ = max_body
         return wrapper
     return decorator
 
 
-def post(path):                                 #视图函数的装饰器，传递储存URL信息(path,method)
+def post(path, max_body=None):                  #视图函数的装饰器，传递储存URL信息(path,method)
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args,**kw):
             return func(*args,**kw)
         wrapper.__method__ = 'POST'
         wrapper.__path__ = path
+        wrapper.__max_body__ = max_body
         return wrapper
     return decorator
 
@@ -84,6 +91,179 @@ def has_request_arg(fn):                            #判断是否有request参
             raise ValueError('request parameter must be the last named parameter in function:%s%s' % (fn.__name__, str(sig)))
     return found
 
+# 根据视图函数参数的类型注解生成转换函数，支持int、float、bool、str、enum、list[...]以及Optional[...]
+# GET参数由parse_qs解析为list，标量类型只接受一个值；转换失败抛出APIValueError
+
+_TRUE = frozenset(('1', 'true', 'yes', 'on'))
+_FALSE = frozenset(('0', 'false', 'no', 'off', ''))
+
+def _to_int(value):
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(value)
+    return int(value)
+
+def _to_float(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    return float(value)
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    v = str(value).lower()
+    if v in _TRUE:
+        return True
+    if v in _FALSE:
+        return False
+    raise ValueError(value)
+
+def _to_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError(value)
+
+def _to_enum(cls):
+    lookup = {}                                     # 按值、值的字符串形式和成员名查找，注册时建好
+    for member in cls:
+        lookup[member.name] = member
+        lookup[str(member.value)] = member
+    def convert(value):
+        if isinstance(value, cls):
+            return value
+        try:
+            return cls(value)
+        except ValueError:
+            return lookup[str(value)]
+    return convert
+
+_scalars = {int: _to_int, float: _to_float, bool: _to_bool, str: _to_str}
+
+def _scalar_converter(annotation):
+    if annotation in _scalars:
+        return _scalars[annotation], annotation.__name__
+    if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+        return _to_enum(annotation), 'one of ' + ', '.join(member.name for member in annotation)
+    return None, None
+
+def make_converter(name, annotation):               #返回value -> 转换后的值的函数，不支持的注解返回None
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    optional = False
+    if origin is typing.Union or origin is types.UnionType:             # Optional[X]、X | None
+        args = tuple(a for a in args if a is not type(None))
+        if len(args) != 1:
+            return None
+        optional = True
+        annotation = args[0]
+        origin = typing.get_origin(annotation)
+        args = typing.get_args(annotation)
+
+    if annotation is list or origin is list:
+        convert, expected = _scalar_converter(args[0]) if args else (None, None)
+        if args and convert is None:
+            return None
+        def check(value):
+            if value is None and optional:
+                return None
+            values = value if isinstance(value, list) else [value]
+            if convert is None:
+                return list(values)
+            try:
+                return [convert(v) for v in values]
+            except (ValueError, TypeError, KeyError):
+                raise APIValueError(name, '%s must be a list of %s' % (name, expected))
+        return check
+
+    convert, expected = _scalar_converter(annotation)
+    if convert is None:
+        return None
+    def check(value):
+        if isinstance(value, list):                 # GET参数
+            if len(value) != 1:
+                raise APIValueError(name, '%s expects a single value' % name)
+            value = value[0]
+        if value is None and optional:
+            return None
+        try:
+            return convert(value)
+        except (ValueError, TypeError, KeyError):
+            raise APIValueError(name, '%s must be %s' % (name, expected))
+    return check
+
+def get_converters(fn):                             #获取有类型注解的参数的转换函数
+    converters = {}
+    for name, param in inspect.signature(fn).parameters.items():
+        if param.annotation is inspect.Parameter.empty or name == 'request':
+            continue
+        convert = make_converter(name, param.annotation)
+        if convert is not None:
+            converters[name] = convert
+    return converters
+
+# 分块读取请求体，累计超过limit立即返回413，不会先把整个请求体读入内存
+
+def _too_large(limit, size):
+    return web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=size)
+
+async def read_body(request, limit):
+    chunks = []
+    size = 0
+    while True:
+        chunk = await request.content.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise _too_large(limit, size)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+async def read_multipart(request, limit):       #逐个读取multipart的各部分，上传的文件直接写入磁盘临时文件
+    form = MultiDict()
+    size = 0
+    reader = await request.multipart()
+    try:
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if not isinstance(part, BodyPartReader) or part.name is None:
+                raise web.HTTPBadRequest(text='Unsupported multipart part.')
+            if part.filename:
+                f = tempfile.TemporaryFile()
+                form.add(part.name, web.FileField(part.name, part.filename, f, part.headers.get(hdrs.CONTENT_TYPE, 'application/octet-stream'), part.headers))
+                while True:
+                    chunk = await part.read_chunk(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > limit:
+                        raise _too_large(limit, size)
+                    f.write(part.decode(chunk))
+                f.seek(0)
+            else:
+                chunks = []
+                while True:
+                    chunk = await part.read_chunk(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > limit:
+                        raise _too_large(limit, size)
+                    chunks.append(chunk)
+                form.add(part.name, part.decode(b''.join(chunks)).decode(part.get_charset(default='utf-8')))
+    except BaseException:
+        close_files(form)
+        raise
+    return form
+
+def close_files(params):                        #关闭（并删除）multipart上传时生成的临时文件
+    for value in params.values():
+        if isinstance(value, web.FileField):
+            value.file.close()
+
 # 定义RequestHandler从视图函数中分析其需要接受的参数，从web.Request中获取必要的参数
 # 调用视图函数，然后把结果转换为web.Response对象，符合aiohttp框架要求
 
@@ -96,76 +276,132 @@ class RequestHandler(object):
         self._has_request_arg = has_request_arg(fn)
         self._has_named_kw_arg = has_named_kw_arg(fn)
         self._has_var_kw_arg = has_var_kw_arg(fn)
-
-    # 1.定义kw，用于保存参数
-    # 2.判断视图函数是否存在关键词参数，如果存在根据POST或者GET方法将request请求内容保存到kw
-    # 3.如果kw为空（说明request无请求内容），则将match_info列表里的资源映射给kw；若不为空，把命名关键词参数内容给kw
-    # 4.完善_has_request_arg和_required_kw_args属性
-    async def __call__(self, request):
-        kw = None
-
-        if self._has_named_kw_arg or self._has_var_kw_arg or self._required_kw_args:     # 若视图函数有命名关键词或关键词参数
-            if request.method == 'POST':
-                if request.content_type == None:                # 根据request参数中的content_type使用不同解析方法：
-                    return web.HTTPBadRequest(text='Missing Content_type')
-                ct = request.content_type.lower()               # 小写，便于检查
-
-                if ct.startswith('application/json'):            # json格式数据
-                    params = await request.json()
+        self._converters = get_converters(fn)
+        self._max_body = getattr(fn, '__max_body__', None) or MAX_BODY_SIZE
+        self._reads_params = bool(self._has_named_kw_arg or self._has_var_kw_arg or self._required_kw_args)     # 是否需要解析请求内容
+        self._bind = self._compile()
+
+    # 注册时根据视图函数的参数选好绑定参数的函数，请求时不再逐项判断、复制kw
+    # 1.请求无参数时（params为None），kw只包含match_info
+    # 2.视图函数只有命名关键词参数时，直接从params中取出这些参数；有关键词参数时，使用全部params
+    # 3.取值的同时按类型注解转换，合并match_info，加入request，检查无默认值的命名关键词参数
+    def _compile(self):
+        required = self._required_kw_args
+        has_request = self._has_request_arg
+        converters = self._converters
+        fields = tuple((name, converters.get(name)) for name in self._named_kw_args)
+
+        def merge(kw, match_info):
+            for name, value in match_info.items():
+                convert = converters.get(name)
+                kw[name] = value if convert is None else convert(value)
+            return kw
+
+        def from_match_info(params, match_info):
+            return merge({}, match_info)
+
+        def only_named(params, match_info):
+            kw = {}
+            for name, convert in fields:
+                if name in params:
+                    value = params[name]
+                    kw[name] = value if convert is None else convert(value)
+            return merge(kw, match_info)
+
+        def all_params(params, match_info):
+            kw = params if type(params) is dict else dict(params)      # json和GET参数已是新建的dict，无需再复制
+            for name, convert in converters.items():
+                if name in kw:
+                    kw[name] = convert(kw[name])
+            return merge(kw, match_info)
+
+        make_kw = only_named if (self._has_named_kw_arg and not self._has_var_kw_arg) else all_params
+
+        def bind(params, request):              # 返回(kw, 缺少的参数名)，类型不符时抛出APIValueError
+            kw = from_match_info(None, request.match_info) if params is None else make_kw(params, request.match_info)
+            if has_request:
+                kw['request'] = request
+            for name in required:
+                if name not in kw:
+                    return None, name
+            return kw, None
+
+        return bind
+
+    async def _read_params(self, request):     # 根据请求方法和content_type解析请求内容，返回dict-like对象，无内容时返回None
+        if request.method == 'POST':
+            if request.content_type == None:                # 根据request参数中的content_type使用不同解析方法：
+                return web.HTTPBadRequest(text='Missing Content_type')
+            ct = request.content_type.lower()               # 小写，便于检查
+            limit = self._max_body
+            if request.content_length is not None and request.content_length > limit:     # 声明的长度已超出上限，不再读取
+                return _too_large(limit, request.content_length)
+
+            try:
+                if ct.startswith('application/json'):            # json格式数据，解析结果直接作为kw
+                    try:
+                        params = json.loads(await read_body(request, limit))
+                    except ValueError:
+                        return web.HTTPBadRequest(text='Invalid JSON body.')
 
                     if not isinstance(params,dict):
                         return web.HTTPBadRequest(text='JSON body must be a object.')
-                    kw = params
+                    return params
 
                     # form表单请求的编码形式
-                elif ct.startwith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()           # 返回post的内容中解析后的数据。dict-like对象。
-                    kw = dict(**params)                     # 组成dict，统一kw格式
+                elif ct.startswith('application/x-www-form-urlencoded'):
+                    body = await read_body(request, limit)
+                    return MultiDict(parse.parse_qsl(body.decode(request.charset or 'utf-8'), True))
+
+                elif ct.startswith('multipart/form-data'):    # 上传的文件为web.FileField，视图函数返回后临时文件即被删除
+                    return await read_multipart(request, limit)
 
                 else:
                     return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+            except web.HTTPException as e:
+                return e
 
-            if request.method == 'GET':
-                qs = request.query_string                   # 返回URL查询语句，?后的键值。string形式
-                if qs:
-                    kw = dict()
-
-                    for k, v in parse.parse_qs(qs,True).items():       # 返回查询变量和值的映射，dict对象。True表示不忽略空格。
-                        kw[k] = v
-
-        if kw == None:
-            kw = dict(**request.match_info)         # 若request中无参数
-            # request.match_info返回dict对象。可变路由中的可变字段{variable}为参数名，传入request请求的path为值
-            # 若存在可变路由：/a/{name}/c，可匹配path为：/a/jack/c的request
-            # 则reqwuest.match_info返回{name = jack}
-
-        else:
-            if self._has_named_kw_arg and (not self._has_var_kw_arg):           # 若视图函数只有命名关键词参数没有关键词参数
-                copy = dict()                                               # 只保留命名关键词参数
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy                                           # kw中只存在命名关键词参数
-
-            # 检查kw中的参数是否和match_info中的重复
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.info('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-
-        if self._has_request_arg:               # 视图函数存在request参数
-             kw['request'] = request
-        if self._required_kw_args:              # 视图函数存在无默认值的命名关键词参数
-            for name in self._required_kw_args:
-                if not name in kw:              # 若未传入必须参数值，报错
-                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
-
-        # 至此，kw为视图函数fn真正能调用的参数
-        # request请求中的参数，终于传递给了视图函数
-
-        r = await self._func(**kw)
+        if request.method == 'GET':
+            qs = request.query_string                   # 返回URL查询语句，?后的键值。string形式
+            if qs:
+                return parse.parse_qs(qs,True)          # 返回查询变量和值的映射，dict对象。True表示不忽略空格。
+        return None
+
+    async def __call__(self, request):
+        params = None
+        if self._reads_params:                          # 若视图函数有命名关键词或关键词参数
+            params = await self._read_params(request)
+            if isinstance(params, web.StreamResponse):
+                return params
+
+        try:
+            kw, missing = self._bind(params, request)
+            if missing is not None:                     # 若未传入必须参数值，报错
+                return web.HTTPBadRequest(text='Missing argument: %s' % missing)
+            logging.debug('call with args: %s', kw)
+
+            # 至此，kw为视图函数fn真正能调用的参数
+            # request请求中的参数，终于传递给了视图函数
+
+            r = await self._func(**kw)
+            return r
+        except APIError as e:                           # 参数校验及视图函数抛出的APIError，返回json
+            return dict(error=e.error, data=e.data, message=e.message)
+        finally:
+            if type(params) is MultiDict:
+                close_files(params)
+
+
+# 将普通函数包装为协程（asyncio.coroutine在python3.11中已移除）
+# @get/@post的wrapper是普通函数，被装饰的视图函数若为协程，其返回值需要再await
+def to_coroutine(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args,**kw):
+        r = fn(*args,**kw)
+        if inspect.isawaitable(r):
+            r = await r
         return r
+    return wrapper
 
 
 # 编写一个add_route函数，用来注册一个视图函数
@@ -177,7 +413,7 @@ def add_route(app,fn):
     # 判断URL处理函数是否协程并且是生成器
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         # 将fn转变成协程
-        fn = asyncio.coroutine(fn)
+        fn = to_coroutine(fn)
 
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ','.join(inspect.signature(fn).parameters.keys())))
     # 在app中注册经RequestHandler类封装的视图函数
@@ -1,6 +1,7 @@
 
 import re, time, json, logging, hashlib, base64, asyncio
 from aiohttp import web
+import orm, serializer
 from coroweb import get, post
 from apis import APIError, APIValueError
 from Models import User, Comment, Blog, next_id
@@ -37,6 +38,25 @@ def user2cookie(user,max_age):
     return '-'.join(L)
 
 
+_sessions = orm.TTLCache(maxsize=10000, ttl=300)     #已验证的cookie缓存,键为cookie值,值为隐藏密码后用户字段的元组
+
+
+@orm.on_change
+def _forget_sessions(model, pk):                    #用户被修改或删除时,清除该用户的所有缓存cookie
+    if model is User:
+        if pk is None:                              #不知道修改了哪些用户,全部清除
+            _sessions.clear()
+            return
+        prefix = '%s-' % pk
+        for key in _sessions.keys():
+            if key.startswith(prefix):
+                _sessions.pop(key)
+
+
+def session_cache_stats():
+    return _sessions.stats()
+
+
 #解析cookie数值
 async def cookie2user(cookie_str):
     if not cookie_str:
@@ -49,6 +69,9 @@ async def cookie2user(cookie_str):
         uid,expires,sha1 = L
         if float(expires)<time.time():      #查看cookie是否过期
             return None
+        fields = _sessions.get(cookie_str)  #缓存中已验证过的cookie,无需再查询数据库
+        if fields:
+            return User(**dict(fields))     #每个请求得到新的实例,修改它不影响缓存和其他请求
         user = await User.find(uid)         #从数据库中查找用户
         if not user:
             return None
@@ -56,7 +79,9 @@ async def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():     #与cookie中的哈希进行比较
             logging.info('invalid sha1')
             return None
+        user = User(**user)                 #在副本上隐藏密码,不修改查询返回的实例
         user.password = '******'
+        _sessions.put(cookie_str,tuple(user.items()))
         return user
     except Exception as e:
         logging.info(e)
@@ -68,7 +93,7 @@ _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
 
 @post('/api/users')                                     #用户注册API
-async def api_register_user(*,email,name,passwd):
+async def api_register_user(*,email: str,name: str,passwd: str):
     if not name or not name.strip():
         raise APIValueError("name")
     if not email or not _RE_EMAIL.match(email):
@@ -90,7 +115,7 @@ async def api_register_user(*,email,name,passwd):
     r.set_cookie(COOKIE_NAME,user2cookie(user,86400),max_age=86400,httponly=True)
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user,ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 
@@ -100,7 +125,7 @@ def signin():
 
 
 @post('/api/authenticate')              #用户登陆API
-async def authenticate(*,email,passwd):
+async def authenticate(*,email: str,passwd: str):
 
     if not email:
         raise APIValueError('email')
@@ -122,7 +147,7 @@ async def authenticate(*,email,passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = "******"
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 
@@ -147,8 +172,8 @@ def check_admin(request):
     if request.__user__ is None or not  request.__user__.admin:
         raise APIValueError('123456')
 
-@post('/api/blogs')
-async def api_create_blogs(request,*,name,summary,content):
+@post('/api/blogs', max_body=4 * 1024 * 1024)          #博客正文可能较长，放宽请求体上限
+async def api_create_blogs(request,*,name: str,summary: str,content: str):
     check_admin(request)
     logging.info('11111111111111')
     if not name or not name.strip():
@@ -163,6 +188,16 @@ async def api_create_blogs(request,*,name,summary,content):
     return blog
 
 
+@get('/metrics')                                #prometheus抓取的数据库指标,需要先调用orm.instrument()才有语句统计
+async def metrics(request):
+    if request.__user__ is None or not request.__user__.admin:  #指标中包含sql语句,只对管理员开放
+        return web.HTTPForbidden()
+    r = web.Response()
+    r.content_type = 'text/plain'
+    r.body = orm.metrics().encode('utf-8')
+    return r
+
+
 #显示创建blog页面
 @get('/manage/blogs/create')
 def manage_create_blog(request):
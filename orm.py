@@ -1,58 +1,585 @@
-import asyncio, logging; logging.basicConfig(level=logging.INFO)
+import asyncio, logging, json, base64, contextvars, time, pickle, re, sqlite3, bisect, os, tempfile; logging.basicConfig(level=logging.INFO)
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 import aiomysql
 
 
-async def create_pool(loop,**kw):                       #创建连接池，方便多次获取数据库连接
+async def create_pool(loop,**kw):                       #创建连接池，方便多次获取数据库连接,backend参数选择数据库:'mysql'(默认)或'sqlite'
     logging.info('create database connection pool...')
-    global _pool                                        #声明全局变量--连接池
-    _pool = await aiomysql.create_pool(
-
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', '3306'),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit',True),
-        maxsize=kw.get('maxsize', 10),                 #池的最大大小
-        minsize=kw.get('mainsize', 1),
-        loop=loop                                      #可选的事件循环
+    global _pool, _replicas, _read_your_writes          #声明全局变量--连接池
+    _set_backend(kw.get('backend', 'mysql'))
+    _pool = await _backend.create_pool(loop, **kw)
+    _replicas = []                                      #只读副本的连接池,select轮流使用
+    for replica in kw.get('replicas', ()):              #副本配置只需写出与主库不同的项,如{'host': '10.0.0.2'}
+        params = dict(kw, **replica)
+        params.pop('replicas')
+        _replicas.append(await _backend.create_pool(loop, **params))
+    _read_your_writes = kw.get('read_your_writes', 1)   #写入后该秒数内本请求的查询仍走主库,避免读不到刚写入的数据
+    logging.info('database connection pool ready: {} connections, {} replicas'.format(_pool.size, len(_replicas)))
+
+
+# 数据库后端:负责创建连接池、选择游标类型、替换占位符,以及少量方言不同的sql语句
+# 连接池需要提供acquire()和size/freesize/minsize/maxsize,连接需要提供cursor()/begin()/commit()/rollback(),与aiomysql一致
+
+class MySQLBackend(object):                             #默认后端,使用aiomysql
+    name = 'mysql'
+    estimates = True                                    #支持通过information_schema/explain估算行数
+    upsert_rowcount = True                              #upsert的受影响行数能区分插入(1)和更新(2)
+
+    async def create_pool(self, loop, **kw):
+        return await aiomysql.create_pool(
+
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', '3306'),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit',True),
+            maxsize=kw.get('maxsize', 10),             #池的最大大小
+            minsize=kw.get('minsize', 1),              #池的最小大小,创建时即建立这么多连接(预热)
+            pool_recycle=kw.get('pool_recycle', -1),   #连接空闲超过该秒数后重新建立,避免使用已被服务端断开的连接,-1表示不回收
+            loop=loop                                  #可选的事件循环
 
+        )
+
+    def cursor(self, tuples=False, streaming=False):    #游标类型:是否返回元组,是否流式读取
+        if streaming:
+            return aiomysql.SSCursor if tuples else aiomysql.SSDictCursor
+        return aiomysql.Cursor if tuples else aiomysql.DictCursor
+
+    def prepare(self, sql):                             #sql语句的占位符为?,mysql里为%s
+        return sql.replace('?', '%s')
+
+    def upsert(self, model):
+        return model.__upsert__
+
+    def add_counters(self, num):                        #num个计数器同时加上各自的增量
+        return 'insert into `counters` (`name`, `value`) values {} on duplicate key update `value`=`value`+values(`value`)'.format(','.join(['(?,?)'] * num))
+
+    def concat(self, a, b):
+        return 'concat({}, {})'.format(a, b)
+
+    def explain(self, sql):
+        return 'explain {}'.format(sql)
+
+
+class SQLiteBackend(MySQLBackend):                      #SQLite后端,用标准库sqlite3在线程中执行,WAL模式,用于本地测试和基准测试,不需要MySQL
+    name = 'sqlite'
+    estimates = False
+    upsert_rowcount = False                             #插入和更新的受影响行数都是1
+
+    async def create_pool(self, loop, **kw):
+        database = kw.get('database') or kw.get('db')
+        if not database:                                #未指定时使用临时文件数据库,多个连接看到的是同一个数据库
+            database = os.path.join(tempfile.mkdtemp(), 'orm.db')
+            logging.info('using temporary sqlite database: {}'.format(database))
+        minsize, maxsize = kw.get('minsize', 1), kw.get('maxsize', 10)
+        if database == ':memory:':                      #需显式指定;每个连接打开的都是各自独立的空数据库,所以只能使用一个连接,
+            minsize = maxsize = 1                       #iterate/iter_all占用该连接时,循环内的其他查询会一直等待
+        pool = SQLitePool(database, minsize, maxsize)
+        await pool.fill()
+        return pool
+
+    def cursor(self, tuples=False, streaming=False):    #sqlite的游标本身就是逐行读取的
+        return tuples
+
+    def prepare(self, sql):                             #sqlite的占位符就是?
+        return sql
+
+    def upsert(self, model):
+        return '{} on conflict(`{}`) do update set {}'.format(model.__insert__, model.__primary_key__, ', '.join(map(lambda f: '`{0}`=excluded.`{0}`'.format(f), model.__fields__)))
+
+    def add_counters(self, num):
+        return 'insert into `counters` (`name`, `value`) values {} on conflict(`name`) do update set `value`=`value`+excluded.`value`'.format(','.join(['(?,?)'] * num))
+
+    def concat(self, a, b):
+        return '({} || {})'.format(a, b)
+
+    def explain(self, sql):
+        return 'explain query plan {}'.format(sql)
+
+
+class SQLiteCursor(object):                             #模仿aiomysql游标的接口,实际操作在连接的线程中执行
+    def __init__(self, conn, tuples):
+        self._conn = conn
+        self._tuples = tuples
+        self._cur = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._cur is not None:
+            await self._conn.run(self._cur.close)
+
+    async def execute(self, sql, args=()):
+        self._cur = await self._conn.run(self._conn.db.execute, sql, tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+
+    def _convert(self, rs):
+        if self._tuples or self._cur.description is None:
+            return rs
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, r)) for r in rs]
+
+    async def fetchmany(self, size):
+        return self._convert(await self._conn.run(self._cur.fetchmany, size))
+
+    async def fetchall(self):
+        return self._convert(await self._conn.run(self._cur.fetchall))
+
+
+class SQLiteConnection(object):                         #每个连接使用一个单独的线程,保证同一连接上的操作按顺序执行
+    def __init__(self, db, executor):
+        self.db = db
+        self._executor = executor
+
+    async def run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def cursor(self, tuples=True):
+        return SQLiteCursor(self, tuples)
+
+    async def begin(self):
+        await self.run(self.db.execute, 'begin')
+
+    async def commit(self):
+        await self.run(self.db.execute, 'commit')
+
+    async def rollback(self):
+        await self.run(self.db.execute, 'rollback')
+
+    async def close(self):
+        await self.run(self.db.close)
+        self._executor.shutdown()
+
+
+class SQLitePool(object):                               #SQLite连接池
+    def __init__(self, database, minsize=1, maxsize=10):
+        self.database = database
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.size = 0
+        self._free = []
+        self._slots = asyncio.Semaphore(maxsize)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    def _connect(self):
+        db = sqlite3.connect(self.database, isolation_level=None, check_same_thread=False)     #isolation_level=None:自动提交,事务由begin/commit控制
+        db.execute('pragma journal_mode=wal')           #WAL模式,读写互不阻塞
+        db.execute('pragma synchronous=normal')
+        return db
+
+    async def _open(self):
+        executor = ThreadPoolExecutor(1)
+        db = await asyncio.get_event_loop().run_in_executor(executor, self._connect)
+        self.size += 1
+        return SQLiteConnection(db, executor)
+
+    async def fill(self):                               #预先建立minsize个连接
+        while self.size < self.minsize:
+            self._free.append(await self._open())
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self._slots:
+            conn = self._free.pop() if self._free else await self._open()
+            try:
+                yield conn
+            finally:
+                self._free.append(conn)
+
+    async def close(self):
+        while self._free:
+            await self._free.pop().close()
+        self.size = 0
+
+
+_backends = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+_backend = MySQLBackend()
+
+
+def _set_backend(name):                                 #切换数据库后端,不同数据库的占位符不同,重新生成固定语句的数据库形式
+    global _backend
+    _backend = _backends[name]()
+    for stmt in _statements:
+        stmt.prepared = _backend.prepare(stmt)
+
+
+_replicas = []
+_read_your_writes = 1
+_next_replica = 0
+_last_write = contextvars.ContextVar('last_write', default=None)    #当前请求最近一次写入的时间
+
+
+class Histogram(object):                                #简单的直方图,按上界统计落入各个桶的次数
+    def __init__(self, buckets=(.001, .005, .01, .05, .1, .5, 1, 5)):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)          #最后一个桶为超过所有上界的次数
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def stats(self):
+        return dict(buckets=list(self.buckets), counts=list(self.counts), count=self.count, sum=self.sum)
+
+    def prometheus(self, name, labels=''):             #prometheus文本格式,桶的计数是累计的
+        lines = []
+        total = 0
+        sep = ',' if labels else ''
+        for bound, n in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += n
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, bound, total))
+        lines.append('{}_sum{} {}'.format(name, '{{{}}}'.format(labels) if labels else '', self.sum))
+        lines.append('{}_count{} {}'.format(name, '{{{}}}'.format(labels) if labels else '', self.count))
+        return lines
+
+
+_acquire_wait = Histogram()                             #从连接池获取连接的等待时间
+
+
+def _choose_pool(readonly):                             #选择连接池:写操作和刚写入过的请求用主库,其余查询轮流使用副本
+    global _next_replica
+    if not readonly or not _replicas:
+        return _pool
+    last = _last_write.get()
+    if last is not None and time.monotonic() - last < _read_your_writes:
+        return _pool
+    _next_replica = (_next_replica + 1) % len(_replicas)
+    return _replicas[_next_replica]
+
+
+@asynccontextmanager
+async def acquire(readonly=False):                      #从连接池获取连接,并记录等待时间
+    tx = _transaction.get()
+    if tx is not None:                                  #事务中的语句都使用事务固定的连接
+        yield tx.conn
+        return
+    start = time.monotonic()
+    async with _choose_pool(readonly).acquire() as conn:
+        _acquire_wait.observe(time.monotonic() - start)
+        yield conn
+
+
+_transaction = contextvars.ContextVar('transaction', default=None)  #当前上下文中进行的事务
+
+
+class Transaction(object):                              #保存事务固定使用的连接、保存点的嵌套层数和提交后才发出的修改通知
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+        self.pending = []                               #(模型类, 主键元组),提交后调用回调并使查询缓存失效,回滚时丢弃
+
+    async def _execute(self, sql):
+        async with self.conn.cursor() as cur:
+            await cur.execute(sql)
+
+
+@asynccontextmanager
+async def transaction():
+    '''
+        事务,用法: async with orm.transaction() as tx:
+        块内的select/execute(包括Model的save/update/remove)都使用同一个连接,正常退出时只提交一次,出现异常则回滚
+        嵌套使用时内层为保存点,内层出错只回滚到保存点
+    '''
+    tx = _transaction.get()
+    if tx is not None:
+        tx.depth += 1
+        savepoint = 'sp_{}'.format(tx.depth)
+        mark = len(tx.pending)
+        await tx._execute('savepoint {}'.format(savepoint))
+        try:
+            yield tx
+        except BaseException:
+            await tx._execute('rollback to savepoint {}'.format(savepoint))
+            for model, pks in tx.pending[mark:]:        #回滚掉的修改不需要通知,但事务中缓存的修改后的记录要清除
+                _forget_identities(model, pks)
+            del tx.pending[mark:]
+            raise
+        else:
+            await tx._execute('release savepoint {}'.format(savepoint))
+        finally:
+            tx.depth -= 1
+        return
+
+    async with acquire() as conn:
+        await conn.begin()
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+        except BaseException:
+            await conn.rollback()
+            for model, pks in tx.pending:
+                _forget_identities(model, pks)
+            raise
+        else:
+            await conn.commit()
+        finally:
+            _transaction.reset(token)
+        for model, pks in tx.pending:                   #已提交,其他请求此时才能读到新数据
+            await _notify(model, pks)
+
+
+def _pool_stats(pool):
+    return dict(
+        minsize=pool.minsize,
+        maxsize=pool.maxsize,
+        size=pool.size,
+        in_use=pool.size - pool.freesize,
+        idle=pool.freesize
     )
 
 
-def log(sql, args=()):
-    logging.info('SQL:{}'.format(sql))             #对logging封装，方便输出sql语句
+def pool_stats():                                       #连接池的状态:大小、使用中和空闲的连接数、获取连接的等待时间
+    stats = _pool_stats(_pool)
+    stats['replicas'] = [_pool_stats(p) for p in _replicas]
+    stats['acquire_wait'] = _acquire_wait.stats()
+    return stats
+
+
+class LRUCache(object):                                 #带淘汰策略的简单LRU缓存,记录命中/未命中次数
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)                     #最近使用的移到末尾
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)              #淘汰最久未使用的
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+
+class TTLCache(LRUCache):                               #带过期时间的LRU缓存,超过ttl秒的条目视为未命中
+    def __init__(self, maxsize=256, ttl=60):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                self._data.pop(key)                     #已过期,顺便清理
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value, ttl=None):
+        super().put(key, (time.monotonic() + (self.ttl if ttl is None else ttl), value))
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+
+class Statement(str):                                   #元类生成的固定语句,同时保存替换好占位符的数据库形式,执行时不用再替换
+    pass
+
 
+_statements = []                                        #所有固定语句,切换后端时重新替换
 
-async def select(sql,args,size=None):              #封装查询事务，第一个参数为sql语句,第二个为sql语句中占位符的参数列表,第三个参数是要查询数据的数量
+
+def statement(sql):
+    stmt = Statement(sql)
+    stmt.prepared = _backend.prepare(sql)
+    _statements.append(stmt)
+    return stmt
+
+
+def prepare(sql):                                       #将?占位符替换为数据库的占位符(mysql为%s),固定语句直接使用预先替换好的形式
+    if type(sql) is Statement:
+        return sql.prepared
+    return _backend.prepare(sql)
+
+
+def statement_cache_stats():
+    return dict(size=len(_statements))
+
+
+def log(sql, args=()):
+    logging.debug('SQL: %s', sql)                   #对logging封装，方便输出sql语句;debug级别且延迟格式化,默认不产生开销
+
+
+class Instrumentation(object):                      #按sql模板统计执行耗时和返回行数,超过slow_threshold秒的语句记录参数和执行计划
+    def __init__(self, slow_threshold=None, max_statements=1000):
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements        #最多统计的不同语句数,超过后新语句不再统计,只计入dropped
+        self.latency = dict()                       #sql模板 -> Histogram
+        self.rows = Counter()                       #sql模板 -> 返回或影响的总行数
+        self.slow = 0
+        self.dropped = 0
+
+    def record(self, sql, args, elapsed, rows):
+        template = sql if type(sql) is Statement else sql_template(sql)
+        histogram = self.latency.get(template)
+        if histogram is None:
+            if len(self.latency) >= self.max_statements:
+                self.dropped += 1
+                return
+            histogram = self.latency[template] = Histogram()
+        histogram.observe(elapsed)
+        self.rows[template] += max(rows, 0)             #ddl等语句的rowcount为-1
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.slow += 1
+            logging.warning('slow query ({:.3f}s): {} args: {!r}'.format(elapsed, sql, args))
+            if sql.lstrip()[:6].lower() == 'select':
+                asyncio.ensure_future(_explain(sql, args))
+
+    def prometheus(self):                           #导出为prometheus文本格式
+        lines = ['# TYPE orm_query_duration_seconds histogram']
+        for sql, histogram in self.latency.items():
+            lines.extend(histogram.prometheus('orm_query_duration_seconds', 'sql="{}"'.format(_escape_label(sql))))
+        lines.append('# TYPE orm_query_rows_total counter')
+        for sql, n in self.rows.items():
+            lines.append('orm_query_rows_total{{sql="{}"}} {}'.format(_escape_label(sql), n))
+        lines.append('# TYPE orm_slow_queries_total counter')
+        lines.append('orm_slow_queries_total {}'.format(self.slow))
+        lines.append('# TYPE orm_dropped_queries_total counter')
+        lines.append('orm_dropped_queries_total {}'.format(self.dropped))
+        return lines
+
+
+_RE_IN_LIST = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+_RE_VALUES_ROWS = re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\1)+')
+
+
+def sql_template(sql):                              #in (?,?,...)和多行values (...),(...)只是长度不同,归为同一个模板统计
+    if '?' not in sql:
+        return sql
+    return _RE_VALUES_ROWS.sub(r'\1', _RE_IN_LIST.sub('in (...)', sql))
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+async def _explain(sql, args):                      #在单独的连接上取慢查询的执行计划并记录
+    _transaction.set(None)                          #在新任务的上下文中执行,不占用事务的连接
+    try:
+        async with acquire(True) as conn:
+            async with conn.cursor(_backend.cursor()) as cur:
+                await cur.execute(prepare(_backend.explain(sql)), args or ())
+                plan = await cur.fetchall()
+        logging.warning('explain: {} => {!r}'.format(sql, plan))
+    except Exception as e:
+        logging.warning('explain failed: {} {}'.format(sql, e))
+
+
+_instrumentation = None                             #为None时不做任何统计
+
+
+def instrument(slow_threshold=None):                #开启统计,slow_threshold为慢查询的秒数,为None时不记录慢查询
+    global _instrumentation
+    _instrumentation = Instrumentation(slow_threshold)
+    return _instrumentation
+
+
+def uninstrument():
+    global _instrumentation
+    _instrumentation = None
+
+
+def query_log():                                    #执行过的sql语句及次数,供schema.py分析缺少的索引,需要先调用instrument()
+    if _instrumentation is None:
+        return dict()
+    return {sql: h.count for sql, h in _instrumentation.latency.items()}
+
+
+def metrics():                                      #prometheus文本格式的指标:语句耗时、返回行数、连接池状态和获取连接的等待时间
+    lines = []
+    if _instrumentation is not None:
+        lines.extend(_instrumentation.prometheus())
+    lines.append('# TYPE orm_pool_acquire_wait_seconds histogram')
+    lines.extend(_acquire_wait.prometheus('orm_pool_acquire_wait_seconds'))
+    if '_pool' in globals():
+        lines.append('# TYPE orm_pool_connections gauge')
+        for i, pool in enumerate([_pool] + _replicas):
+            stats = _pool_stats(pool)
+            for state in ('in_use', 'idle'):
+                lines.append('orm_pool_connections{{pool="{}",state="{}"}} {}'.format(i, state, stats[state]))
+    return '\n'.join(lines) + '\n'
+
+
+async def select(sql,args,size=None,tuples=False):  #封装查询事务，第一个参数为sql语句,第二个为sql语句中占位符的参数列表,第三个参数是要查询数据的数量,tuples为True时每行返回元组
 
     log(sql, args)
+    instrumentation = _instrumentation
 
-    async with _pool.acquire() as conn:                             #通过连接池获取数据库连接
-        async with conn.cursor(aiomysql.DictCursor) as cur:         #获取游标,默认游标返回的结果为元组,每一项是另一个元组,这里可以指定元组的元素为字典通过aiomysql.DictCursor
+    async with acquire(True) as conn:                               #通过连接池获取数据库连接
+        async with conn.cursor(_backend.cursor(tuples)) as cur:     #获取游标,默认游标返回的结果为元组,每一项是另一个元组,这里可以指定元组的元素为字典通过aiomysql.DictCursor
                                                                     #调用游标的execute()方法来执行sql语句,execute()接收两个参数,第一个为sql语句可以包含占位符,第二个为占位符对应的值,使用该形式可以避免直接使用字符串拼接出来的sql的注入攻击
-            await cur.execute(sql.replace('?','%s'),args or ())     #sql语句的占位符为?,mysql里为%s,做替换
+            if instrumentation is not None:
+                start = time.monotonic()
+            await cur.execute(prepare(sql),args or ())              #sql语句的占位符为?,mysql里为%s,做替换
             if size:
                 rs = await cur.fetchmany(size)                      #size有值就获取对应数量的数据
             else:
                 rs = await cur.fetchall()                           #获取所有数据库中的所有数据,此处返回的是一个数组,数组元素为字典
 
-        logging.info('rows returned: {}'.format(len(rs)))
+        if instrumentation is not None:
+            instrumentation.record(sql, args, time.monotonic() - start, len(rs))
         return rs
 
 
 async def execute(sql,args,autocommit=True):       #该协程封装了增删改的操作
     log(sql)
+    _last_write.set(time.monotonic())
+
+    if _transaction.get() is not None:             #已在事务中,由transaction()负责提交或回滚
+        autocommit = True
 
-    async with _pool.acquire() as conn:
+    async with acquire() as conn:
         if not autocommit:                          #如果不是自动提交事务,需要手动启动,但是我发现这个是可以省略的
             await conn.begin()
 
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?','%s'),args)
+            instrumentation = _instrumentation
+            if instrumentation is not None:
+                start = time.monotonic()
+            async with conn.cursor(_backend.cursor()) as cur:
+                await cur.execute(prepare(sql),args)
                 affected = cur.rowcount
+            if instrumentation is not None:
+                instrumentation.record(sql, args, time.monotonic() - start, affected)
             if not autocommit:
                 await conn.commit()
         except BaseException as e:
@@ -62,6 +589,158 @@ async def execute(sql,args,autocommit=True):       #该协程封装了增删改
         return affected
 
 
+async def iterate(sql, args, batch_size=1000, tuples=False):    #流式查询,使用服务端游标分批读取,不会把结果集一次性读入内存
+    log(sql, args)
+
+    async with acquire(True) as conn:
+        async with conn.cursor(_backend.cursor(tuples, True)) as cur:
+            await cur.execute(prepare(sql),args or ())
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                yield rs
+
+
+_identities = contextvars.ContextVar('identities', default=None)    #当前请求的主键缓存(identity map),键为(表名,主键)
+
+
+@contextmanager
+def identity_map():                                     #在with块内(通常是一次请求)重复的Model.find(pk)只查询一次数据库
+    token = _identities.set(dict())
+    try:
+        yield
+    finally:
+        _identities.reset(token)
+
+
+_change_listeners = []                                  #记录被修改时的回调函数列表,参数为(模型类,主键)
+
+
+def on_change(fn):                                      #注册回调,save/update/remove之后调用,用于清理各类缓存
+    _change_listeners.append(fn)
+    return fn
+
+
+async def invalidate(model, *pks):                      #通知某些记录已被修改,不传主键表示整张表都可能被修改,此时回调的主键参数为None
+    _forget_identities(model, pks)                      #本请求的主键缓存立即清除,事务中随后的查询能读到自己的修改
+    tx = _transaction.get()
+    if tx is not None:                                  #事务提交前其他请求读到的还是旧数据,提交后再通知,否则旧数据会以新版本号被缓存
+        tx.pending.append((model, pks))
+        return
+    await _notify(model, pks)
+
+
+def _forget_identities(model, pks):                     #从本请求的主键缓存中删除这些记录,pks为空时删除整张表的记录
+    identities = _identities.get()
+    if identities is None:
+        return
+    if not pks:
+        for key in [k for k in identities if k[0] == model.__table__]:
+            identities.pop(key)
+    for pk in pks:
+        identities.pop((model.__table__, pk), None)
+
+
+async def _notify(model, pks):                          #调用回调,使查询缓存失效
+    if not pks:
+        for fn in _change_listeners:
+            fn(model, None)
+    for pk in pks:
+        for fn in _change_listeners:
+            fn(model, pk)
+    await _query_cache.invalidate(model.__table__)
+
+
+class MemoryCacheBackend(object):                       #进程内的查询缓存后端
+    def __init__(self, maxsize=1024):
+        self._cache = TTLCache(maxsize)
+        self._counters = dict()                         #计数器不参与淘汰,否则表的版本号会被重置
+
+    async def get(self, key):
+        return self._cache.get(key)
+
+    async def set(self, key, value, ttl):
+        self._cache.put(key, value, ttl)
+
+    async def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    async def incr(self, key):
+        self._counters[key] = self._counters.get(key, 0) + 1
+
+
+class RedisCacheBackend(object):                        #redis查询缓存后端,多个进程共享;client为redis.asyncio.Redis等提供get/set/incr协程的客户端
+    def __init__(self, client, prefix='orm:'):
+        self.client = client
+        self.prefix = prefix
+
+    async def get(self, key):
+        value = await self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    async def set(self, key, value, ttl):
+        await self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    async def get_counter(self, key):
+        return int(await self.client.get(self.prefix + key) or 0)
+
+    async def incr(self, key):
+        await self.client.incr(self.prefix + key)
+
+
+class QueryCache(object):                               #查询结果缓存,键中包含表的版本号,表有写入时版本号加一,旧的缓存自然失效
+    def __init__(self, backend=None, ttl=60):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def key(self, table, sql, args):
+        generation = await self.backend.get_counter('gen:{}'.format(table))
+        return '{}:{}:{}:{!r}'.format(table, generation, ' '.join(sql.split()), list(args or ()))
+
+    async def get(self, key):
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key, value):
+        await self.backend.set(key, value, self.ttl)
+
+    async def invalidate(self, table):
+        await self.backend.incr('gen:{}'.format(table))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+
+_query_cache = QueryCache()
+
+
+def set_query_cache(backend=None, ttl=60):              #设置查询缓存的后端和过期时间,findAll/findNumber传入cache=True时使用
+    global _query_cache
+    _query_cache = QueryCache(backend, ttl)
+
+
+def query_cache_stats():
+    return _query_cache.stats()
+
+
+async def cached_select(table, sql, args, size=None, tuples=False):    #带缓存的select,表有写入时缓存失效
+    if _transaction.get() is not None:                  #事务中能读到未提交的数据,可能被回滚,不读写缓存
+        return await select(sql, args, size, tuples)
+    key = await _query_cache.key(table, sql, args)
+    rs = await _query_cache.get(key)
+    if rs is None:
+        rs = await select(sql, args, size, tuples)
+        await _query_cache.set(key, rs)
+    return rs
+
+
 def create_args_string(num):                    #创建拥有几个占位符的字符串
     L = []
     for n in range(num):
@@ -70,11 +749,12 @@ def create_args_string(num):                    #创建拥有几个占位符的
 
 
 class Field(object):                                     #该类是为了保存 数据库列名 和 类型 的基类
-    def __init__(self,name,column_type,primary_key,defalut):
+    def __init__(self,name,column_type,primary_key,defalut,deferred=False):
         self.name = name                                 #列名
         self.column_type = column_type                   #数据类型
         self.primary_key = primary_key                   #是否为主键
         self.default = defalut                           #默认值
+        self.deferred = deferred                         #是否延迟加载,默认查询不包含该列,需要时用load()加载
 
     def __str__(self):
         return '{}, {}:{}'.format(self.__class__.__name__,self.column_type,self.name)
@@ -102,8 +782,72 @@ class FloatField(Field):                                #整数型 列名
 
 
 class TextField(Field):                                 #文本型 列名
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, deferred=False, ddl='text'):
+        super().__init__(name, ddl, False, default, deferred)
+
+
+class Relation(object):                                 #关系声明的基类,不对应数据库列,只用于批量预加载关联记录
+    def __init__(self,model,key,many):
+        self.model = model                              #关联的模型类名
+        self.key = key                                  #外键列名
+        self.many = many                                #是否一对多
+
+    @property
+    def target(self):                                   #按类名延迟解析,允许引用在后面定义的模型
+        return _models[self.model]
+
+    def __str__(self):
+        return '{}, {}:{}'.format(self.__class__.__name__,self.model,self.key)
+
+
+class HasMany(Relation):                                #一对多,外键在关联表上,如 Blog.comments = HasMany('Comment','blog_id')
+    def __init__(self,model,key):
+        super().__init__(model,key,True)
+
+
+class BelongsTo(Relation):                              #多对一,外键在本表上,如 Comment.user = BelongsTo('User','user_id')
+    def __init__(self,model,key):
+        super().__init__(model,key,False)
+
+
+_models = dict()                                        #已定义的模型类,键为类名
+
+
+class Row(object):                                      #紧凑的记录对象,使用__slots__保存字段,比dict子类的Model省内存、属性访问快;字段可以修改,但不记录修改,要写回数据库需先to_model()
+    __slots__ = ()
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def to_model(self):                                 #转换为Model实例,用于save/update/remove
+        return self.__model__(**self.to_dict())
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join('{}={!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+
+def _make_row_class(model, names=None):                 #为模型生成对应的Row子类,只包含names中的列(默认为全部列),未查询的列不会出现在to_dict/to_model中
+    names = list(names or [model.__primary_key__] + model.__fields__)
+    code = 'def __init__(self, {}):\n    {}\n'.format(
+        ', '.join('{}=None'.format(n) for n in names),
+        '\n    '.join('self.{0} = {0}'.format(n) for n in names))
+    code += 'def to_dict(self):\n    return {{{}}}\n'.format(', '.join("'{0}': self.{0}".format(n) for n in names))
+    namespace = {}
+    exec(code, namespace)                               #生成的__init__、to_dict逐个赋值,没有循环和getattr的开销
+    return type(model.__name__ + 'Row', (Row,), dict(__slots__=tuple(names), __init__=namespace['__init__'], to_dict=namespace['to_dict'], __model__=model))
+
+
+def _make_row_factory(model, names, compact=False):     #为模型生成从元组游标的一行直接构造实例的函数,元组顺序与names一致
+    kw = ', '.join('{}=r[{}]'.format(n, i) for i, n in enumerate(names))
+    if compact:
+        code = 'def from_row(r):\n    return cls({})\n'.format(kw)
+        full = list(names) == [model.__primary_key__] + model.__fields__
+        namespace = dict(cls=model.__row__ if full else _make_row_class(model, names))     #只查询了部分列时,Row只包含这些列
+    else:
+        code = 'def from_row(r):\n    o = _new(cls)\n    _init(o, {})\n    return o\n'.format(kw)
+        namespace = dict(cls=model, _new=dict.__new__, _init=dict.__init__)
+    exec(code, namespace)                               #跳过DictCursor生成的中间字典和cls(**r)的关键字参数解包
+    return namespace['from_row']
 
 
 class ModeMetaclass(type):                              #元类
@@ -135,9 +879,16 @@ class ModeMetaclass(type):                              #元类
         if not primaryKey:
             raise StandardError('primary key not found')    #没找到主键
 
-        for k in mappings.keys():
+        relations = dict()                              #存储关系名和关系声明的映射
+        for k, v in attrs.items():
+            if isinstance(v,Relation):
+                logging.info('found relation:{} ==> {}'.format(k,v))
+                relations[k] = v
+
+        for k in list(mappings.keys()) + list(relations.keys()):
             attrs.pop(k)                                #清空attrs
         escaped_fields = list(map(lambda f: '`{}`'.format(f), fields))          #将fields中属性名以`属性名`的方式装饰起来
+        columns = [primaryKey] + [f for f in fields if not mappings[f].deferred]  #默认查询的列,不包含延迟加载的列
 
         #重新设置attrs，类的属性和方法都放在fields，主键属性放在primary_key
 
@@ -145,25 +896,58 @@ class ModeMetaclass(type):                              #元类
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey
         attrs['__fields__'] = fields
+        attrs['__columns__'] = columns
+        attrs['__relations__'] = relations
+        counters = tuple(attrs.get('__counters__', None) or ())                 #需要维护计数的分组列,如('blog_id',),声明后还会维护整张表的总数
+        for c in counters:
+            if c not in fields:
+                raise ValueError('Invalid counter column: {}'.format(c))
+        attrs['__counters__'] = counters
+        indexes = dict()                                #索引,键为列名元组,值为是否唯一;__indexes__/__unique__中的每一项为列名或列名元组
+        for unique, key in ((False, '__indexes__'), (True, '__unique__')):
+            for index in attrs.get(key, None) or ():
+                index = (index,) if isinstance(index, str) else tuple(index)
+                for c in index:
+                    if c not in mappings:
+                        raise ValueError('Invalid index column: {}'.format(c))
+                indexes[index] = unique
+        attrs['__indexes__'] = indexes
 
         #以下四种方法保存了默认了增删改查操作,其中添加的反引号``,是为了避免与sql关键字冲突的,否则sql语句会执行出错
 
-        attrs['__select__'] = 'select `{}`, {} from `{}`'.format(primaryKey, ', '.join(escaped_fields), tableName)
-        attrs['__insert__'] = 'insert into `{}` ({}, `{}`) values ({})'.format(tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `{}` set {} where `{}`=?'.format(tableName, ', '.join(map(lambda f: '`{}`=?'.format(mappings.get(f).name or f), fields)), primaryKey)
-        attrs['__delete__'] = 'delete from `{}` where `{}`=?'.format(tableName, primaryKey)
-        return type.__new__(cls,name,bases,attrs)
+        attrs['__select__'] = statement('select {} from `{}`'.format(', '.join(map(lambda f: '`{}`'.format(f), columns)), tableName))
+        attrs['__find__'] = statement('{} where `{}`=?'.format(attrs['__select__'], primaryKey))
+        attrs['__insert__'] = statement('insert into `{}` ({}, `{}`) values ({})'.format(tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1)))
+        attrs['__update__'] = statement('update `{}` set {} where `{}`=?'.format(tableName, ', '.join(map(lambda f: '`{}`=?'.format(mappings.get(f).name or f), fields)), primaryKey))
+        attrs['__delete__'] = statement('delete from `{}` where `{}`=?'.format(tableName, primaryKey))
+        attrs['__upsert__'] = statement('{} on duplicate key update {}'.format(attrs['__insert__'], ', '.join(map(lambda f: '`{0}`=values(`{0}`)'.format(f), fields))))
+        model = type.__new__(cls,name,bases,attrs)
+        model.__row__ = _make_row_class(model)          #紧凑记录类,findAll(compact=True)时使用
+        model.__factories__ = dict()                    #按查询列缓存的元组构造函数
+        model.__from_row__ = staticmethod(model._factory(tuple(columns)))  #查询结果为元组时的构造函数
+        _models[name] = model
+        return model
 
 
 
 class Model(dict,metaclass=ModeMetaclass):      #这是模型的基类,继承于dict,主要作用就是如果通过点语法来访问对象的属性获取不到的话,可以定制__getattr__来通过key来再次获取字典里的值
     def __init__(self,**kw):
         super().__init__(**kw)
+        self.__dict__['_new'] = True                #自己创建的对象,不知道哪些列被修改过;从数据库查询出的对象没有该标记,会记录修改过的列
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        d = self.__dict__
+        if '_new' not in d:
+            d.setdefault('_dirty', set()).add(key)  #记录修改过的列,update()只更新这些列
 
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            field = self.__mappings__.get(key)
+            if field is not None and field.deferred:
+                raise AttributeError(r"deferred field '{}' is not loaded, call await load('{}') first".format(key, key))
             raise AttributeError(r"'Model' object has no attribute '{}'".format(key))
 
     def __setattr__(self, key, value):
@@ -182,17 +966,49 @@ class Model(dict,metaclass=ModeMetaclass):      #这是模型的基类,继承于
                 setattr(self,key,value)
         return value
 
-
-    @classmethod
-    async def findAll(cls, where=None, args=None,**kw):
+    async def load(self, *names):
         '''
-            通过where查找多条记录对象
-            :param where:where查询条件
-            :param args:sql参数
-            :param kw:查询条件列表
-            :return:多条记录集合
+            加载延迟加载的列(或查询时未选择的列)
+            :param names: 要加载的属性名,不传则加载所有尚未加载的列
+            :return: 自身
         '''
-        sql = [cls.__select__]
+        names = [n for n in (names or self.__fields__) if n not in self]
+        if names:
+            rs = await select('select {} from `{}` where `{}`=?'.format(', '.join(map(lambda f: '`{}`'.format(f), names)), self.__table__, self.__primary_key__), [self.getValue(self.__primary_key__)], 1, tuples=True)
+            if rs:
+                dict.update(self, zip(names, rs[0]))    #Model.update是更新数据库的方法,这里直接调用dict的update
+        return self
+
+
+    @classmethod
+    def _factory(cls, names, compact=False):            #按查询列取得(必要时生成)元组构造函数
+        key = (names, compact)
+        factory = cls.__factories__.get(key)
+        if factory is None:
+            factory = _make_row_factory(cls, names, compact)
+            cls.__factories__[key] = factory
+        return factory
+
+    @classmethod
+    def _projection(cls, columns=None):                 #查询的列名元组,主键总是包含在第一列
+        if columns is None:
+            return tuple(cls.__columns__)
+        names = [cls.__primary_key__]
+        for c in columns:
+            if c not in cls.__mappings__:
+                raise ValueError('Invalid column name: {}'.format(c))
+            if c not in names:
+                names.append(c)
+        return tuple(names)
+
+
+    @classmethod
+    def _build_select(cls, where=None, args=None, **kw):   #拼接查询语句,返回sql、参数列表和查询的列名
+        names = cls._projection(kw.get('columns',None))
+        if names == tuple(cls.__columns__):
+            sql = [cls.__select__]
+        else:                                               #只查询指定的列
+            sql = ['select {} from `{}`'.format(', '.join(map(lambda f: '`{}`'.format(f), names)), cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
@@ -217,28 +1033,221 @@ class Model(dict,metaclass=ModeMetaclass):      #这是模型的基类,继承于
             else:
                 raise ValueError('Invalid limit value: {}'.format(str(limit)))
 
-        rs = await select(' '.join(sql),args)
+        return ' '.join(sql), args, names
+
+
+    @classmethod
+    async def findAll(cls, where=None, args=None,**kw):
+        '''
+            通过where查找多条记录对象
+            :param where:where查询条件
+            :param args:sql参数
+            :param kw:查询条件列表,orderBy/limit,以及columns(只查询的列)、prefetch(预加载的关系名列表)、compact(为True时返回紧凑的Row对象)、cache(为True时使用查询缓存)
+            :return:多条记录集合
+        '''
+        sql, args, names = cls._build_select(where, args, **kw)
+        if kw.get('cache',False):
+            rs = await cached_select(cls.__table__,sql,args,tuples=True)
+        else:
+            rs = await select(sql,args,tuples=True)                 #列顺序固定为names的顺序,用元组游标
+
+        if kw.get('compact',False):                                 #返回紧凑的Row对象
+            from_row = cls._factory(names, True)
+            return [from_row(r) for r in rs]
+
+        from_row = cls._factory(names)
+        objs = [from_row(r) for r in rs]
+        prefetch = kw.get('prefetch',None)
+        if prefetch:
+            await cls.prefetch(objs, prefetch)
+        return objs
 
-        return [cls(**r) for r in rs]
+
+    @classmethod
+    async def prefetch(cls, objs, names, chunk_size=500):
+        '''
+            批量加载关联记录,每个关系只用 in (...) 查询,避免N+1次查询
+            :param objs: 本模型的记录集合
+            :param names: 要加载的关系名列表,如['comments']
+            :param chunk_size: 每条语句包含的键数量
+            :return: 无,关联记录保存在每条记录的同名属性中
+        '''
+        for name in names:
+            relation = cls.__relations__.get(name)
+            if relation is None:
+                raise ValueError('Invalid relation name: {}'.format(name))
+            target = relation.target
+            if relation.many:                                       #一对多:按本表主键查关联表的外键
+                groups = {}
+                keys = list(OrderedDict.fromkeys(o.getValue(cls.__primary_key__) for o in objs))
+                for i in range(0, len(keys), chunk_size):
+                    chunk = keys[i:i + chunk_size]
+                    children = await target.findAll('`{}` in ({})'.format(relation.key, create_args_string(len(chunk))), list(chunk))
+                    for child in children:
+                        groups.setdefault(child.getValue(relation.key), []).append(child)
+                for o in objs:
+                    o[name] = groups.get(o.getValue(cls.__primary_key__), [])
+            else:                                                   #多对一:按本表外键查关联表的主键
+                found = await target.find_many([o.getValue(relation.key) for o in objs], as_dict=True, chunk_size=chunk_size)
+                for o in objs:
+                    o[name] = found.get(o.getValue(relation.key))
+
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch_size=1000, **kw):
+        '''
+            流式查询多条记录,用法: async for blog in Blog.iter_all(...)
+            :param where:where查询条件
+            :param args:sql参数
+            :param batch_size:每次从服务端读取的行数
+            :param kw:查询条件列表,同findAll
+            :return:逐条返回记录对象的异步生成器
+        '''
+        sql, args, names = cls._build_select(where, args, **kw)
+        from_row = cls._factory(names)
+        async for rs in iterate(sql, args, batch_size, tuples=True):
+            for r in rs:
+                yield from_row(r)
 
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def find_page(cls, order_by='created_at desc', after=None, size=20, where=None, args=None):
+        '''
+            按游标分页(keyset分页),翻到多深都只扫描一页的数据,适合按有索引的列排序
+            :param order_by: 排序列及方向,如'created_at desc'
+            :param after: 上一页返回的游标,为None时取第一页
+            :param size: 每页的记录数
+            :param where: 额外的where查询条件
+            :param args: where条件的参数列表
+            :return: (记录集合, 下一页游标),没有下一页时游标为None
+        '''
+        parts = order_by.split()
+        column = parts[0].strip('`')
+        desc = len(parts) > 1 and parts[1].lower() == 'desc'
+        if column not in cls.__columns__ or len(parts) > 2:     #只能按默认查询的列排序,游标要从查询结果中取该列的值
+            raise ValueError('Invalid order_by value: {}'.format(order_by))
+        if not isinstance(size, int) or size < 1:
+            raise ValueError('Invalid size value: {}'.format(size))
+        pk = cls.__primary_key__
+        direction, op = ('desc', '<') if desc else ('asc', '>')
+
+        sql = [cls.__select__]
+        conds = []
+        args = list(args or [])
+        if where:
+            conds.append('({})'.format(where))
+        if after:
+            try:
+                value, key = json.loads(base64.urlsafe_b64decode(after.encode('ascii')).decode('utf-8'))
+            except Exception:
+                raise ValueError('Invalid cursor value: {}'.format(after))
+            #(列值,主键)组合比较,列值相同的记录按主键继续排序,保证不重复不遗漏
+            #外层的 列<=? 使数据库能用该列的索引做范围扫描,只写成or的形式时会取出游标之后的所有记录再排序
+            conds.append('(`{0}` {2}= ? and (`{0}` {2} ? or `{1}` {2} ?))'.format(column, pk, op))
+            args.extend([value, value, key])
+        if conds:
+            sql.append('where')
+            sql.append(' and '.join(conds))
+        sql.append('order by `{0}` {2}, `{1}` {2} limit ?'.format(column, pk, direction))
+        args.append(size + 1)                                       #多取一条,用于判断是否还有下一页
+
+        rs = await select(' '.join(sql), args, tuples=True)
+        objs = list(map(cls.__from_row__, rs[:size]))
+        cursor = None
+        if len(rs) > size:
+            last = objs[-1]
+            cursor = base64.urlsafe_b64encode(json.dumps([last[column], last[pk]]).encode('utf-8')).decode('ascii')
+        return objs, cursor
+
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None, cache=False, mode='exact'):
         '''
             查询某个字段的数量
             :param selectField: 要查询的字段
             :param where: where查询条件
             :param args: 参数列表
+            :param cache: 为True时使用查询缓存
+            :param mode: 'exact'精确计数;'estimated'估算,无where时读information_schema,有where时取explain的行数;
+                         'cached'读取save/remove时维护的计数器,where只能为空或 `__counters__中的列`=?
             :return: 数量
         '''
+        if mode == 'cached':
+            return await cls._cached_number(where, args)
         sql = ['select count({}) _num_ from `{}`'.format(selectField,cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql),args,1)
+        if mode == 'estimated' and _backend.estimates:     #不支持估算的数据库退回精确计数
+            if where:
+                rs = await select('explain {}'.format(' '.join(sql)),args)
+                return rs[0]['rows'] or 0
+            rs = await select('select table_rows _num_ from information_schema.tables where table_schema=database() and table_name=?',[cls.__table__],1)
+            return rs[0]['_num_'] if rs else 0
+        if mode not in ('exact', 'estimated'):
+            raise ValueError('Invalid mode value: {}'.format(mode))
+        if cache:
+            rs = await cached_select(cls.__table__,' '.join(sql),args,1)
+        else:
+            rs = await select(' '.join(sql),args,1)
         return rs[0]['_num_']
 
 
+    @classmethod
+    async def _cached_number(cls, where=None, args=None):  #从计数器表读取数量
+        if not cls.__counters__:
+            raise ValueError('No counters declared for table: {}'.format(cls.__table__))
+        if not where:
+            name = cls.__table__
+        else:
+            m = re.fullmatch(r'\s*`?(\w+)`?\s*=\s*\?\s*', where)
+            if m is None or m.group(1) not in cls.__counters__:
+                raise ValueError('Invalid where value for cached count: {}'.format(where))
+            name = '{}.{}={}'.format(cls.__table__, m.group(1), args[0])
+        rs = await select('select `value` _num_ from `counters` where `name`=?',[name],1)
+        return rs[0]['_num_'] if rs else 0
+
+    def _counter_names(self, values=None):                  #该记录所属的计数器名,values为从数据库读取的计数列
+        names = [self.__table__]
+        for c in self.__counters__:
+            value = values[c] if values and c in values else self.getValue(c)
+            names.append('{}.{}={}'.format(self.__table__, c, value))
+        return names
+
+    @classmethod
+    async def _execute_counted(cls, sql, args, names, delta, expect=None):
+        '''
+            执行写入语句,声明了计数器的模型在同一事务中更新计数器
+            :param names: 受影响记录的计数器名列表,可重复
+            :param delta: 每条记录对计数的增量,插入为1,删除为-1
+            :param expect: 只有受影响行数等于该值时才更新计数器,为None时受影响行数大于0即更新
+            :return: 受影响的行数
+        '''
+        if not cls.__counters__:
+            return await execute(sql, args)
+        async with transaction():
+            rows = await execute(sql, args)
+            if (rows == expect) if expect is not None else rows > 0:
+                await cls._add_counters(names, delta)
+        return rows
+
+    @classmethod
+    async def _add_counters(cls, names, delta):             #每个计数器加上 出现次数*delta
+        counts = Counter(names)
+        values = []
+        for name, n in counts.items():
+            values.extend([name, n * delta])
+        await execute(_backend.add_counters(len(counts)), values)
+
+    @classmethod
+    async def rebuild_counters(cls):                        #按表中的实际数据重新计算计数器,用于修改了分组列或计数器不一致时
+        async with transaction():
+            await execute('delete from `counters` where `name`=? or `name` like ?', [cls.__table__, '{}.%'.format(cls.__table__)])
+            await execute('insert into `counters` (`name`, `value`) select ?, count(*) from `{}`'.format(cls.__table__), [cls.__table__])
+            for c in cls.__counters__:
+                await execute('insert into `counters` (`name`, `value`) select {2}, count(*) from `{1}` group by `{0}`'.format(c, cls.__table__, _backend.concat('?', '`{}`'.format(c))), ['{}.{}='.format(cls.__table__, c)])
+
+
     @classmethod
     async def find(cls,pk):
         '''
@@ -246,10 +1255,53 @@ class Model(dict,metaclass=ModeMetaclass):      #这是模型的基类,继承于
             :param pk:id
             :return: 一条记录
         '''
-        rs = await select('{} where `{}`=?'.format(cls.__select__,cls.__primary_key__),[pk],1)
-        if len(rs) == 0:
+        identities = _identities.get()
+        if identities is None:
+            return await cls._find(pk)
+        key = (cls.__table__, pk)
+        task = identities.get(key)
+        if task is None:                                    #同一主键的并发查询共用一个任务,只查询一次
+            task = asyncio.ensure_future(cls._find_row(pk))
+            identities[key] = task
+        try:
+            r = await asyncio.shield(task)
+        except Exception:
+            if identities.get(key) is task:
+                identities.pop(key)
+            raise
+        return None if r is None else cls.__from_row__(r)   #缓存的是查询结果,每次返回新的实例,调用方的修改不会影响其他调用方
+
+    @classmethod
+    async def find_many(cls, pks, as_dict=False, chunk_size=500):
+        '''
+            通过多个id批量查询,每chunk_size个id一条 where id in (...) 语句
+            :param pks: id列表,重复的id只查询一次
+            :param as_dict: 为True时返回 {id: 记录} 字典,只包含找到的记录
+            :param chunk_size: 每条语句包含的id数量
+            :return: 与pks顺序一致的记录列表,找不到的位置为None
+        '''
+        keys = list(OrderedDict.fromkeys(pks))                      #去重并保持顺序
+        found = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            rs = await select('{} where `{}` in ({})'.format(cls.__select__, cls.__primary_key__, create_args_string(len(chunk))), chunk, tuples=True)
+            for r in rs:
+                found[r[0]] = cls.__from_row__(r)                  #元组第一列为主键
+        if as_dict:
+            return found
+        return [found.get(pk) for pk in pks]
+
+    @classmethod
+    async def _find(cls,pk):
+        r = await cls._find_row(pk)
+        if r is None:
             return None
-        return cls(**rs[0])
+        return cls.__from_row__(r)
+
+    @classmethod
+    async def _find_row(cls,pk):                            #按主键查询一行,返回元组
+        rs = await select(cls.__find__,[pk],1,tuples=True)
+        return rs[0] if rs else None
 
 
     #一下的都是对象方法,所以可以不用传任何参数,方法内部可以使用该对象的所有属性,及其方便
@@ -258,22 +1310,111 @@ class Model(dict,metaclass=ModeMetaclass):      #这是模型的基类,继承于
 
         args = list(map(self.getValueOrDefault,self.__fields__))         #得到对应字段的值
         args.append(self.getValueOrDefault(self.__primary_key__))       #主键值
-        rows = await execute(self.__insert__,args)
+        rows = await self._execute_counted(self.__insert__,args,self._counter_names(),1)
+        await invalidate(self.__class__, args[-1])
+        self._clean()
         if rows != 1:
             logging.warning('failed to insert record: affected rows: {}'.format(rows))
 
+    async def upsert(self):                                 #插入记录,主键已存在时更新该记录(insert ... on duplicate key update)
+        args = list(map(self.getValueOrDefault,self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        sql = _backend.upsert(self.__class__)
+        if not self.__counters__ or _backend.upsert_rowcount:
+            rows = await self._execute_counted(sql,args,self._counter_names(),1,expect=1)   #mysql插入时受影响行数为1,更新时为2,没有变化时为0
+        else:                                               #无法从受影响行数区分插入和更新,在同一事务中先检查主键是否已存在
+            async with transaction():
+                exists = await select('select 1 from `{}` where `{}`=?'.format(self.__table__, self.__primary_key__), [args[-1]], 1)
+                rows = await execute(sql, args)
+                if not exists:
+                    await self._add_counters(self._counter_names(), 1)
+        await invalidate(self.__class__, args[-1])
+        self._clean()
+        return rows
+
+    def _clean(self):                                       #已与数据库一致,之后开始记录修改过的列
+        self.__dict__.pop('_new', None)
+        self.__dict__['_dirty'] = set()
+
+    @classmethod
+    async def save_many(cls, instances, chunk_size=500):
+        '''
+            批量保存多条记录,每chunk_size条拼成一条多行insert语句
+            :param instances: 模型实例列表
+            :param chunk_size: 每条insert语句包含的行数
+            :return: 每批受影响的行数列表
+        '''
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk_size value: {}'.format(chunk_size))
+        keys = cls.__fields__ + [cls.__primary_key__]               #与__insert__中的列顺序一致
+        row = '({})'.format(create_args_string(len(keys)))
+        head = cls.__insert__[:cls.__insert__.rindex(' values ')]
+        counts = []
+        for i in range(0, len(instances), chunk_size):
+            chunk = instances[i:i + chunk_size]
+            args = []
+            for inst in chunk:
+                args.extend(map(inst.getValueOrDefault, keys))
+            names = [name for inst in chunk for name in inst._counter_names()]
+            rows = await cls._execute_counted('{} values {}'.format(head, ','.join([row] * len(chunk))), args, names, 1)
+            await invalidate(cls, *[inst.getValue(cls.__primary_key__) for inst in chunk])
+            if rows != len(chunk):
+                logging.warning('failed to insert records: affected rows: {} of {}'.format(rows, len(chunk)))
+            counts.append(rows)
+        return counts
+
     async def update(self):                                 #更新记录
-        args = list(map(self.getValue, self.__fields__))
+        if '_new' in self.__dict__:
+            fields = [f for f in self.__fields__ if f in self]   #未加载的列(延迟加载或未查询的列)不更新,避免被写成NULL
+        else:
+            dirty = self.__dict__.get('_dirty', ())
+            fields = [f for f in self.__fields__ if f in dirty]  #只更新修改过的列
+        if not fields:
+            logging.info('nothing to update for {} {}'.format(self.__table__, self.getValue(self.__primary_key__)))
+            return
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+        else:
+            sql = 'update `{}` set {} where `{}`=?'.format(self.__table__, ', '.join(map(lambda f: '`{}`=?'.format(self.__mappings__[f].name or f), fields)), self.__primary_key__)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
+        await invalidate(self.__class__, args[-1])
+        self._clean()
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: {}'.format(rows))
 
+    @classmethod
+    async def update_where(cls, where, args=None, **values):
+        '''
+            按条件批量更新,一条语句完成,无需先查询再逐条更新
+            :param where: where查询条件
+            :param args: where条件的参数列表
+            :param values: 要更新的列和值
+            :return: 受影响的行数
+        '''
+        if not values:
+            raise ValueError('No values to update')
+        for k in values:
+            if k not in cls.__fields__:
+                raise ValueError('Invalid column name: {}'.format(k))
+        sql = 'update `{}` set {} where {}'.format(cls.__table__, ', '.join(map(lambda f: '`{}`=?'.format(cls.__mappings__[f].name or f), values)), where)
+        rows = await execute(sql, list(values.values()) + list(args or []))
+        await invalidate(cls)                               #不知道具体修改了哪些记录,整张表的缓存都失效
+        return rows
+
     async def remove(self):                                 #删除一条记录
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        missing = [c for c in self.__counters__ if c not in self]
+        if missing:                                         #计数列未加载,在同一事务中先从数据库读出,再删除并更新计数器
+            async with transaction():
+                rs = await select('select {} from `{}` where `{}`=?'.format(', '.join(map(lambda f: '`{}`'.format(f), missing)), self.__table__, self.__primary_key__), args, 1)
+                rows = await self._execute_counted(self.__delete__, args, self._counter_names(rs[0] if rs else None), -1)
+        else:
+            rows = await self._execute_counted(self.__delete__, args, self._counter_names(), -1)
+        await invalidate(self.__class__, args[0])
         if rows != 1:
-            logging.warning('failed to remove by primary key: affected rows: %s'.format(rows))
+            logging.warning('failed to remove by primary key: affected rows: {}'.format(rows))
 
 
 
@@ -0,0 +1,101 @@
+'''
+根据Models中模型的__mappings__生成建表语句,并根据orm记录的查询语句建议缺少的索引
+
+用法:
+    python schema.py [mysql|sqlite]         输出所有模型的建表语句
+'''
+
+import re, sys
+
+import orm
+import Models
+
+COUNTERS_TABLE = {                              #计数器表,声明了__counters__的模型使用
+    'mysql': ('create table counters (\n'
+              '    `name` varchar(200) not null,\n'
+              '    `value` bigint not null,\n'
+              '    primary key (`name`)\n'
+              ') engine=innodb default charset=utf8;'),
+    'sqlite': ('create table counters (\n'
+               '    `name` varchar(200) not null,\n'
+               '    `value` bigint not null,\n'
+               '    primary key (`name`)\n'
+               ');')
+}
+
+
+def index_name(columns):
+    return 'idx_{}'.format('_'.join(columns))
+
+
+def create_table(model, dialect='mysql'):       #生成一个模型的建表语句,sqlite的索引为单独的create index语句
+    lines = ['    `{}` {} not null,'.format(k, model.__mappings__[k].column_type) for k in [model.__primary_key__] + model.__fields__]
+    statements = []
+    for columns, unique in model.__indexes__.items():
+        cols = ', '.join(map(lambda c: '`{}`'.format(c), columns))
+        if dialect == 'mysql':
+            lines.append('    {}key `{}` ({}),'.format('unique ' if unique else '', index_name(columns), cols))
+        else:
+            statements.append('create {}index `{}_{}` on `{}` ({});'.format('unique ' if unique else '', model.__table__, index_name(columns), model.__table__, cols))
+    lines.append('    primary key (`{}`)'.format(model.__primary_key__))
+    tail = ') engine=innodb default charset=utf8;' if dialect == 'mysql' else ');'
+    statements.insert(0, 'create table {} (\n{}\n{}'.format(model.__table__, '\n'.join(lines), tail))
+    return statements
+
+
+def create_schema(models=None, dialect='mysql'):  #生成所有模型的建表语句
+    if models is None:
+        models = orm._models.values()
+    statements = []
+    for model in models:
+        statements.extend(create_table(model, dialect))
+    if any(model.__counters__ for model in models):
+        statements.append(COUNTERS_TABLE[dialect])
+    return statements
+
+
+_RE_TABLE = re.compile(r'\b(?:from|update|into)\s+`?(\w+)`?', re.I)
+_RE_WHERE = re.compile(r'\bwhere\b(.*?)(?:\border\s+by\b|\bgroup\s+by\b|\blimit\b|$)', re.I | re.S)
+_RE_ORDER = re.compile(r'\border\s+by\s+`?(\w+)`?', re.I)
+_RE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<=|>=|<>|!=|<|>|\bin\b|\blike\b|\bbetween\b)', re.I)
+
+
+def advise_indexes(query_log=None):
+    '''
+        分析执行过的sql语句,找出where条件(及order by)用到、但没有以其开头的索引的列
+        :param query_log: {sql: 执行次数},默认使用orm.query_log(),需要先调用orm.instrument()开启统计
+        :return: [(表名, 建议索引的列名元组, 执行次数, sql)],按执行次数从多到少排序
+    '''
+    if query_log is None:
+        query_log = orm.query_log()
+    tables = {model.__table__.lower(): model for model in orm._models.values()}
+    advice = {}
+    for sql, count in query_log.items():
+        m = _RE_TABLE.search(sql)
+        model = m and tables.get(m.group(1).lower())
+        if model is None:
+            continue
+        columns = []
+        m = _RE_WHERE.search(sql)
+        if m:
+            columns = [c for c in _RE_COLUMN.findall(m.group(1)) if c in model.__mappings__]
+        m = _RE_ORDER.search(sql)
+        if m and m.group(1) in model.__mappings__:
+            columns.append(m.group(1))
+        columns = tuple(dict.fromkeys(columns))                 #去重并保持顺序
+        if not columns:
+            continue
+        leading = {model.__primary_key__} | {index[0] for index in model.__indexes__}
+        if columns[0] in leading:                               #已有以该列开头的索引
+            continue
+        key = (model.__table__, columns)
+        if key in advice:
+            advice[key][2] += count
+        else:
+            advice[key] = [model.__table__, columns, count, sql]
+    return sorted(map(tuple, advice.values()), key=lambda a: -a[2])
+
+
+if __name__ == '__main__':
+    dialect = sys.argv[1] if len(sys.argv) > 1 else 'mysql'
+    print('\n\n'.join(create_schema(dialect=dialect)))
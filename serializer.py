@@ -0,0 +1,67 @@
+'''
+响应的json序列化:按orjson、ujson、json的顺序选用已安装的实现,直接输出utf-8编码的bytes
+
+Model是dict的子类,各实现都能原生序列化;Row和其他对象交给default处理
+各实现的耗时比较见 python bench.py serialize [n]
+'''
+
+import json
+
+import orm
+
+
+def default(obj):                               #无法原生序列化的对象:Row转为dict,其他对象使用__dict__
+    if isinstance(obj, orm.Row):
+        return obj.to_dict()
+    return obj.__dict__
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+
+_encoders = {'json': _json_dumps}               #名称 -> dumps(obj)函数,返回bytes
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+else:
+    def _orjson_dumps(obj):                     #orjson直接输出utf-8 bytes,默认即序列化dict子类
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+    _encoders['orjson'] = _orjson_dumps
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+else:
+    def _ujson_dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+    _encoders['ujson'] = _ujson_dumps
+
+_encoder = next(name for name in ('orjson', 'ujson', 'json') if name in _encoders)
+_dumps = _encoders[_encoder]
+
+
+def set_encoder(name, dumps=None):
+    '''
+        选择序列化使用的实现
+        :param name: 'orjson'、'ujson'、'json'或自定义名称
+        :param dumps: 自定义实现,接受一个对象返回bytes;给出时以name注册
+    '''
+    global _encoder, _dumps
+    if dumps is not None:
+        _encoders[name] = dumps
+    if name not in _encoders:
+        raise ValueError('json encoder not available: {}'.format(name))
+    _encoder, _dumps = name, _encoders[name]
+
+
+def encoder():
+    return _encoder
+
+
+def dumps(obj):                                 #序列化为utf-8编码的bytes
+    return _dumps(obj)
+